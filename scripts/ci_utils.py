@@ -1,4 +1,6 @@
+import functools
 import os
+import shlex
 import subprocess
 import sys
 from contextlib import contextmanager
@@ -24,19 +26,16 @@ def run(
     capture_output: bool = False,
 ) -> subprocess.CompletedProcess:
     """Run a command with optional grouping and error handling."""
-    cmd_str = " ".join(str(c) for c in cmd)
-    
     # Don't group if capturing output, as it's likely an internal check
     should_group = not capture_output
     
     if should_group:
-        print(f"::group::{cmd_str}")
+        print(f"::group::{shlex.join(str(c) for c in cmd)}")
     
     try:
-        run_env = os.environ.copy()
-        if env:
-            run_env.update(env)
-            
+        # Inherit the parent environment directly unless overrides are given
+        run_env = {**os.environ, **env} if env else None
+
         result = subprocess.run(
             cmd,
             env=run_env,
@@ -54,6 +53,22 @@ def run(
         if should_group:
             print("::endgroup::")
 
+@functools.lru_cache(maxsize=1)
+def os_release() -> Dict[str, str]:
+    """Parse /etc/os-release into a dict; empty if the file is missing."""
+    release: Dict[str, str] = {}
+    try:
+        with open("/etc/os-release") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#") or "=" not in line:
+                    continue
+                key, value = line.split("=", 1)
+                release[key] = value.strip("\"'")
+    except FileNotFoundError:
+        pass
+    return release
+
 def fail(msg: str) -> None:
     """Exit with an error message."""
     sys.exit(f"Error: {msg}")
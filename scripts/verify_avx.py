@@ -4,44 +4,235 @@ Build and verify AVX-presume gating for the bundled opus library.
 
 - Builds a generic target (no presume feature) and expects no AVX flag/instructions.
 - Builds a presume target (presume-avx2 feature) and expects AVX flag/instructions.
+- Skips a target when its inputs match the fingerprint of its last successful check.
 """
 
+import functools
+import hashlib
+import os
+import shlex
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Any, List, Optional, Tuple
 import ci_utils
 
 
 PRESUME_FLAG = "OPUS_X86_PRESUME_AVX2:BOOL=ON"
+FINGERPRINT_FILE = ".verify_fingerprint"
+REPO_ROOT = Path(__file__).resolve().parent.parent
+# Files outside opus/ that affect how bands.c.o is built or checked
+FINGERPRINT_EXTRA = [
+    Path("build.rs"),
+    Path("Cargo.toml"),
+    Path("Cargo.lock"),
+    Path(__file__),
+    Path(ci_utils.__file__),
+]
+# Environment variables read by cargo, the cmake/cc crates or the compiler,
+# matched by prefix so new per-target or per-profile variants are covered
+FINGERPRINT_ENV_PREFIXES = (
+    "CARGO_PROFILE_",
+    "CARGO_BUILD_",
+    "CARGO_TARGET_",
+    "CARGO_ENCODED_RUSTFLAGS",
+    "CARGO_HOME",
+    "RUSTFLAGS",
+    "CC",
+    "CXX",
+    "CFLAGS",
+    "CXXFLAGS",
+    "CPPFLAGS",
+    "LDFLAGS",
+    "CMAKE",
+    "TARGET_",
+    "HOST_",
+)
+
+TARGETS = [
+    # (target_dir, features, expect_flag, expect_avx)
+    ("target/ci-generic", "", False, False),
+    ("target/ci-presume", "presume-avx2", True, True),
+]
 
 
 def newest_build_dir(target_dir: Path) -> Optional[Path]:
     build_root = target_dir / "release" / "build"
-    if not build_root.exists():
-        return None
-    # Find all opus-codec-* directories
-    candidates = [p for p in build_root.glob("opus-codec-*") if p.is_dir()]
-    if not candidates:
+    if not build_root.is_dir():
         return None
-    # Return the most recently modified one
-    return max(candidates, key=lambda p: p.stat().st_mtime)
+    # Track the most recently modified opus-codec-* directory in a single pass
+    newest: Optional[str] = None
+    newest_mtime = 0.0
+    with os.scandir(build_root) as it:
+        for entry in it:
+            if not entry.name.startswith("opus-codec-") or not entry.is_dir():
+                continue
+            mtime = entry.stat().st_mtime
+            if newest is None or mtime > newest_mtime:
+                newest, newest_mtime = entry.path, mtime
+    return Path(newest) if newest else None
 
 
 def find_artifacts(base: Path) -> Tuple[Optional[Path], Optional[Path]]:
-    # Recursive search for artifacts
-    caches = list(base.rglob("CMakeCache.txt"))
-    objs = list(base.rglob("bands.c.o"))
-    return (caches[0] if caches else None), (objs[0] if objs else None)
+    # Single depth-first walk that stops once both artifacts have been found
+    cache: Optional[str] = None
+    obj: Optional[str] = None
+    stack = [str(base)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif cache is None and entry.name == "CMakeCache.txt":
+                    cache = entry.path
+                elif obj is None and entry.name == "bands.c.o":
+                    obj = entry.path
+                if cache and obj:
+                    return Path(cache), Path(obj)
+    return (Path(cache) if cache else None), (Path(obj) if obj else None)
+
+
+def has_ymm_instructions(obj: Path) -> bool:
+    # Stream the disassembly and stop at the first YMM operand instead of
+    # buffering the whole listing in memory. Scanning the raw section bytes
+    # for VEX prefixes is not reliable: 0xC4/0xC5 also occur as ModRM,
+    # displacement and immediate bytes, so instructions have to be decoded.
+    cmd = ["objdump", "-d", "--no-show-raw-insn", str(obj)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, bufsize=1 << 16)
+    found = False
+    try:
+        for line in proc.stdout:
+            if "ymm" in line:
+                found = True
+                break
+    finally:
+        proc.stdout.close()
+        if found:
+            proc.terminate()
+        returncode = proc.wait()
+    if not found and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return found
+
+
+def compiler_command(host: str) -> List[str]:
+    # Resolve the C compiler in the same order as the cc crate
+    for name in (f"CC_{host}", f"CC_{host.replace('-', '_')}", "TARGET_CC", "CC"):
+        value = os.environ.get(name)
+        if value:
+            return shlex.split(value)
+    return ["cc"]
+
+
+@functools.lru_cache(maxsize=1)
+def toolchain_versions() -> Optional[str]:
+    # Returns None if any version can't be determined, so nothing is skipped
+    try:
+        rustc = ci_utils.run(["rustc", "-vV"], capture_output=True).stdout
+        host = ""
+        for line in rustc.splitlines():
+            if line.startswith("host:"):
+                host = line.split(":", 1)[1].strip()
+        versions = [rustc]
+        for cmd in (["cmake", "--version"], compiler_command(host) + ["--version"]):
+            versions.append(ci_utils.run(cmd, capture_output=True).stdout)
+    except (OSError, ValueError, subprocess.CalledProcessError) as exc:
+        print(f"Could not determine toolchain versions ({exc}), not skipping any target")
+        return None
+    return "\n".join(versions)
+
+
+def cargo_config_files() -> List[Path]:
+    # Cargo merges .cargo/config{,.toml} from the cwd upwards plus CARGO_HOME
+    cwd = Path.cwd().resolve()
+    dirs = [d / ".cargo" for d in (cwd, *cwd.parents)]
+    dirs.append(Path(os.environ.get("CARGO_HOME") or Path.home() / ".cargo"))
+    return [d / name for d in dirs for name in ("config", "config.toml")]
+
+
+def hash_file(h: Any, path: Path, label: str) -> None:
+    if not path.is_file():
+        return
+    h.update(label.encode() + b"\0")
+    h.update(path.read_bytes())
+
+
+def repo_relative(path: Path) -> str:
+    # Keep the fingerprint stable when the checkout moves
+    resolved = path.resolve()
+    try:
+        return resolved.relative_to(REPO_ROOT).as_posix()
+    except ValueError:
+        return resolved.name
+
+
+def input_fingerprint(features: str) -> Optional[str]:
+    # Hash everything that can change the bundled opus build output; None
+    # means the inputs can't be pinned down and the target must be rebuilt
+    toolchain = toolchain_versions()
+    if toolchain is None:
+        return None
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(features.encode())
+    h.update(toolchain.encode())
+    for name in sorted(os.environ):
+        if name.startswith(FINGERPRINT_ENV_PREFIXES):
+            h.update(f"{name}={os.environ[name]}\n".encode())
+    # Every file under opus/ is hashed, since CMake also reads templates
+    # and source lists that a suffix allowlist would miss
+    sources = [p for p in Path("opus").rglob("*") if p.is_file()]
+    for p in sorted(sources) + FINGERPRINT_EXTRA:
+        hash_file(h, p, repo_relative(p))
+    for i, p in enumerate(cargo_config_files()):
+        hash_file(h, p, f"cargo-config-{i}-{p.name}")
+    return h.hexdigest()
+
+
+def is_verified(target_dir: str, fingerprint: str) -> bool:
+    stored = Path(target_dir) / FINGERPRINT_FILE
+    try:
+        return stored.read_text().strip() == fingerprint
+    except OSError:
+        return False
+
 
+def mark_verified(target_dir: str, fingerprint: str) -> None:
+    (Path(target_dir) / FINGERPRINT_FILE).write_text(fingerprint + "\n")
 
-def verify(target_dir: str, features: str, expect_flag: bool, expect_avx: bool) -> None:
-    # Build
+
+def build_jobs() -> str:
+    # Split the available cores between the concurrent builds
+    return os.environ.get("CARGO_BUILD_JOBS") or str(max(1, (os.cpu_count() or 2) // 2))
+
+
+def build_step(target_dir: str, features: str) -> subprocess.CompletedProcess:
     cmd = ["cargo", "build", "--release"]
     if features:
         cmd += ["--features", features]
-    
-    ci_utils.run(cmd, env={"CARGO_TARGET_DIR": target_dir})
 
-    # Verify
+    # Capture the output so concurrent builds don't interleave their logs
+    return ci_utils.run(
+        cmd,
+        env={"CARGO_TARGET_DIR": target_dir, "CARGO_BUILD_JOBS": build_jobs()},
+        check=False,
+        capture_output=True,
+    )
+
+
+def report_build(target_dir: str, result: subprocess.CompletedProcess) -> None:
+    with ci_utils.group(f"[{target_dir}] {shlex.join(result.args)}"):
+        print(result.stdout, end="")
+        print(result.stderr, end="")
+        if result.returncode != 0:
+            print(f"Command failed with exit code {result.returncode}")
+
+
+def check_step(target_dir: str, expect_flag: bool, expect_avx: bool) -> None:
     target = Path(target_dir)
     build_dir = newest_build_dir(target)
     if not build_dir:
@@ -56,20 +247,16 @@ def verify(target_dir: str, features: str, expect_flag: bool, expect_avx: bool)
         print("Found bands.c.o:", [str(p) for p in target.rglob("bands.c.o")])
         ci_utils.fail("Missing required build artifacts")
 
-    # Check CMake cache for flag
-    cache_content = cache.read_text()
-    flag_present = PRESUME_FLAG in cache_content
+    # Check CMake cache for flag, stopping at the first matching line
+    with cache.open("r", buffering=1 << 15) as f:
+        flag_present = any(PRESUME_FLAG in line for line in f)
     if flag_present != expect_flag:
         ci_utils.fail(
             f"AVX presume flag mismatch in {cache}: expected={expect_flag}, got={flag_present}"
         )
 
     # Check object file for AVX instructions
-    disasm = ci_utils.run(
-        ["objdump", "-d", str(obj)], capture_output=True
-    ).stdout
-    
-    has_avx = "ymm" in disasm
+    has_avx = has_ymm_instructions(obj)
     if has_avx != expect_avx:
         ci_utils.fail(
             f"AVX instructions mismatch in {obj}: expected={expect_avx}, got={has_avx}"
@@ -77,8 +264,33 @@ def verify(target_dir: str, features: str, expect_flag: bool, expect_avx: bool)
 
 
 def main() -> None:
-    verify("target/ci-generic", "", False, False)
-    verify("target/ci-presume", "presume-avx2", True, True)
+    # Skip targets whose inputs are unchanged since their last successful check
+    pending = []
+    for target_dir, features, expect_flag, expect_avx in TARGETS:
+        fingerprint = input_fingerprint(features)
+        if fingerprint and is_verified(target_dir, fingerprint):
+            print(f"Inputs unchanged for {target_dir}, skipping build and verify")
+            continue
+        pending.append((target_dir, features, expect_flag, expect_avx, fingerprint))
+
+    # The targets use disjoint CARGO_TARGET_DIRs, so build them concurrently
+    with ThreadPoolExecutor(max_workers=max(1, len(pending))) as pool:
+        builds = [
+            pool.submit(build_step, target_dir, features)
+            for target_dir, features, _, _, _ in pending
+        ]
+        results = [build.result() for build in builds]
+
+    for (target_dir, *_), result in zip(pending, results):
+        report_build(target_dir, result)
+    for (target_dir, *_), result in zip(pending, results):
+        if result.returncode != 0:
+            ci_utils.fail(f"cargo build failed for {target_dir} (exit code {result.returncode})")
+
+    for target_dir, _, expect_flag, expect_avx, fingerprint in pending:
+        check_step(target_dir, expect_flag, expect_avx)
+        if fingerprint:
+            mark_verified(target_dir, fingerprint)
 
 
 if __name__ == "__main__":
@@ -6,12 +6,27 @@ Verify system libopus usage:
 - Builds and tests with the `system-lib` feature.
 """
 
+import functools
+import http.client
+import random
+import shutil
 import subprocess
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
 import ci_utils
 
+try:
+    import ssl  # noqa: F401
+
+    HAS_SSL = True
+except ImportError:
+    HAS_SSL = False
+
 DEB_URLS = {
     "dev": [
         "https://deb.debian.org/debian/pool/main/o/opus/libopus-dev_1.5.2-2_amd64.deb",
@@ -26,7 +41,8 @@ DEB_URLS = {
 EXPECTED_VERSION = "1.5.2"
 
 
-def pkg_config_version() -> Optional[str]:
+@functools.lru_cache(maxsize=1)
+def _query_pkg_config() -> Optional[str]:
     try:
         out = ci_utils.run(
             ["pkg-config", "--modversion", "opus"], capture_output=True
@@ -37,14 +53,58 @@ def pkg_config_version() -> Optional[str]:
         return None
 
 
-def download_first(urls, dest: Path) -> bool:
+def pkg_config_version(refresh: bool = False) -> Optional[str]:
+    # Only re-run pkg-config after an install step may have changed the answer
+    if refresh:
+        _query_pkg_config.cache_clear()
+    return _query_pkg_config()
+
+
+def apt_candidate_version(package: str) -> Optional[str]:
+    try:
+        out = ci_utils.run(
+            ["apt-cache", "policy", package], capture_output=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as exc:
+        print(f"apt-cache policy failed: {exc}")
+        return None
+    for line in out.splitlines():
+        key, _, value = line.strip().partition(":")
+        if key == "Candidate":
+            value = value.strip()
+            return None if value == "(none)" else value
+    return None
+
+
+def upstream_version(deb_version: str) -> str:
+    # Strip the epoch and Debian revision: "1:1.5.2-2" -> "1.5.2"
+    return deb_version.split(":", 1)[-1].rsplit("-", 1)[0]
+
+
+def fetch(url: str, dest: Path) -> None:
+    if not HAS_SSL:
+        # urllib can't speak HTTPS without the ssl module; fall back to curl
+        ci_utils.run(["curl", "-fLsS", url, "-o", str(dest)])
+        return
+    with urllib.request.urlopen(url, timeout=30) as resp, dest.open("wb") as f:
+        shutil.copyfileobj(resp, f, 1 << 16)
+
+
+def download_first(urls, dest: Path, attempts: int = 3) -> bool:
     for u in urls:
-        try:
-            ci_utils.run(["curl", "-fLsS", u, "-o", str(dest)])
-            print(f"Downloaded {u}")
-            return True
-        except subprocess.CalledProcessError:
-            print(f"Download failed from {u}, trying next mirror...")
+        for attempt in range(attempts):
+            try:
+                fetch(u, dest)
+                print(f"Downloaded {u}")
+                return True
+            except (OSError, http.client.HTTPException, subprocess.CalledProcessError) as exc:
+                print(f"Download attempt {attempt + 1} failed from {u}: {exc}")
+                # Client errors such as 404 won't go away on retry
+                if isinstance(exc, urllib.error.HTTPError) and exc.code < 500:
+                    break
+                if attempt + 1 < attempts:
+                    time.sleep(2**attempt + random.random())
+        print(f"Giving up on {u}, trying next mirror...")
     return False
 
 
@@ -54,51 +114,71 @@ def install_debs_if_needed() -> None:
         print(f"libopus already at {EXPECTED_VERSION}")
         return
 
-    # Fast path: try the packaged version first.
+    # Fast path: try the packaged version first, unless apt would only
+    # install a different version anyway.
+    install_attempted = False
     with ci_utils.group("Install libopus-dev from apt"):
         try:
             ci_utils.run(["sudo", "apt-get", "update"])
-            ci_utils.run(["sudo", "apt-get", "install", "-y", "libopus-dev"])
+            candidate = apt_candidate_version("libopus-dev")
+            if candidate and upstream_version(candidate) != EXPECTED_VERSION:
+                print(f"apt candidate for libopus-dev is {candidate}, skipping apt install")
+            else:
+                install_attempted = True
+                ci_utils.run(["sudo", "apt-get", "install", "-y", "libopus-dev"])
         except subprocess.CalledProcessError:
             print("apt-get install libopus-dev failed, will try deb mirrors")
 
-    ver_after_apt = pkg_config_version()
+    # A failed install may still have changed the installed version
+    ver_after_apt = pkg_config_version(refresh=install_attempted)
     if ver_after_apt == EXPECTED_VERSION:
         print(f"libopus at {EXPECTED_VERSION} after apt install")
         return
 
     # Try downloading Debian packages on Ubuntu runners.
     # Only proceed if /etc/os-release indicates Ubuntu.
-    os_release = Path("/etc/os-release")
-    if os_release.exists():
-        data = os_release.read_text().lower()
-        if "ubuntu" not in data:
-            ci_utils.fail(
-                f"Expected libopus {EXPECTED_VERSION} but found {ver_after_apt}; not on Ubuntu, aborting"
-            )
-    else:
+    release = ci_utils.os_release()
+    if not release:
         ci_utils.fail(
             f"Expected libopus {EXPECTED_VERSION} but found {ver_after_apt}; /etc/os-release missing"
         )
+    if release.get("ID") != "ubuntu":
+        ci_utils.fail(
+            f"Expected libopus {EXPECTED_VERSION} but found {ver_after_apt}; not on Ubuntu, aborting"
+        )
 
     runtime_deb = Path("/tmp/libopus0.deb")
     dev_deb = Path("/tmp/libopus-dev.deb")
 
     with ci_utils.group("Download libopus debs"):
-        ok = download_first(DEB_URLS["runtime"], runtime_deb) and download_first(
-            DEB_URLS["dev"], dev_deb
-        )
+        # Fetch both packages concurrently so a slow mirror doesn't stall each in turn
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            runtime_ok = pool.submit(download_first, DEB_URLS["runtime"], runtime_deb)
+            dev_ok = pool.submit(download_first, DEB_URLS["dev"], dev_deb)
+            ok = runtime_ok.result() and dev_ok.result()
         if not ok:
             ci_utils.fail("Failed to download libopus debs from all mirrors")
 
+    # apt-get resolves dependencies of local debs in the same transaction;
+    # the distro may already ship a newer libopus0, so allow downgrades.
     with ci_utils.group("Install libopus debs"):
         try:
-            ci_utils.run(["sudo", "dpkg", "-i", str(runtime_deb), str(dev_deb)])
-        except subprocess.CalledProcessError:
-            print("dpkg failed, trying apt-get install -f")
-            ci_utils.run(["sudo", "apt-get", "install", "-f", "-y"])
+            ci_utils.run(
+                [
+                    "sudo",
+                    "apt-get",
+                    "install",
+                    "-y",
+                    "--no-install-recommends",
+                    "--allow-downgrades",
+                    str(runtime_deb),
+                    str(dev_deb),
+                ]
+            )
+        except subprocess.CalledProcessError as exc:
+            ci_utils.fail(f"Failed to install libopus debs: {exc}")
 
-    ver_after = pkg_config_version()
+    ver_after = pkg_config_version(refresh=True)
     if ver_after != EXPECTED_VERSION:
         ci_utils.fail(
             f"After deb install, expected libopus {EXPECTED_VERSION} but found {ver_after}"
@@ -112,7 +192,7 @@ def main() -> None:
     if ver != EXPECTED_VERSION:
         ci_utils.fail(f"Expected libopus {EXPECTED_VERSION} but found {ver}")
 
-    ci_utils.run(["cargo", "build", "--features", "system-lib"])
+    # cargo test builds the library as well, so a separate build step is redundant
     ci_utils.run(["cargo", "test", "--features", "system-lib"])
 
 